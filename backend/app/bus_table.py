@@ -0,0 +1,123 @@
+import math
+from typing import Dict, List, Optional, Tuple, Any
+import numpy as np
+
+class ActiveBusTable:
+    """Columnar in-memory store of the latest update and detection result for each active bus"""
+    
+    def __init__(self, capacity: int = 64):
+        # Bumped on every write so callers can cache views of the table
+        self.version = 0
+        
+        # Row lookup
+        self.ids: List[str] = []
+        self.idx: Dict[str, int] = {}
+        
+        # Numeric columns (NaN where speed or bearing was not reported)
+        self.capacity = capacity
+        self.lat = np.empty(capacity)
+        self.lon = np.empty(capacity)
+        self.speed = np.empty(capacity)
+        self.timestamp = np.empty(capacity)
+        self.bearing = np.empty(capacity)
+        self.is_ghost = np.zeros(capacity, dtype=bool)
+        
+        # Object columns
+        self.route_id: List[str] = []
+        self.trip_id: List[Optional[str]] = []
+        self.anomaly_types: List[List[str]] = []
+        self.severity: List[str] = []
+    
+    def __len__(self) -> int:
+        return len(self.ids)
+    
+    def __contains__(self, bus_id: str) -> bool:
+        return bus_id in self.idx
+    
+    def upsert(self, bus_id: str, bus_dict: Dict[str, Any], result: Tuple[bool, List[str], str]):
+        """Write a dumped bus update and its detection result into the bus's row, adding it if new"""
+        row = self.idx.get(bus_id)
+        if row is None:
+            row = self._append_row(bus_id)
+        
+        speed = bus_dict.get("speed")
+        bearing = bus_dict.get("bearing")
+        is_ghost, anomaly_types, severity = result
+        
+        self.lat[row] = bus_dict["lat"]
+        self.lon[row] = bus_dict["lon"]
+        self.speed[row] = speed if speed is not None else math.nan
+        self.timestamp[row] = bus_dict["timestamp"]
+        self.bearing[row] = bearing if bearing is not None else math.nan
+        self.is_ghost[row] = is_ghost
+        self.route_id[row] = bus_dict["route_id"]
+        self.trip_id[row] = bus_dict.get("trip_id")
+        self.anomaly_types[row] = anomaly_types
+        self.severity[row] = severity
+        self.version += 1
+    
+    def get(self, bus_id: str) -> Optional[Dict[str, Any]]:
+        """Get the bus payload for a single bus"""
+        row = self.idx.get(bus_id)
+        if row is None:
+            return None
+        return self._records(slice(row, row + 1))[0]
+    
+    def to_records(self) -> List[Dict[str, Any]]:
+        """Get the bus payloads for all buses, converting each column in one pass"""
+        return self._records(slice(0, len(self.ids)))
+    
+    def _records(self, rows: slice) -> List[Dict[str, Any]]:
+        """Build bus payloads for a range of rows"""
+        return [
+            {
+                "id": bus_id,
+                "lat": lat,
+                "lon": lon,
+                "route_id": route_id,
+                "speed": None if speed != speed else speed,  # NaN check
+                "timestamp": timestamp,
+                "bearing": None if bearing != bearing else bearing,
+                "trip_id": trip_id,
+                "is_ghost": is_ghost,
+                "anomaly_types": anomaly_types,
+                "severity": severity,
+                "status": "ghost" if is_ghost else "active"
+            }
+            for bus_id, lat, lon, route_id, speed, timestamp, bearing, trip_id, is_ghost, anomaly_types, severity in zip(
+                self.ids[rows],
+                self.lat[rows].tolist(),
+                self.lon[rows].tolist(),
+                self.route_id[rows],
+                self.speed[rows].tolist(),
+                self.timestamp[rows].tolist(),
+                self.bearing[rows].tolist(),
+                self.trip_id[rows],
+                self.is_ghost[rows].tolist(),
+                self.anomaly_types[rows],
+                self.severity[rows]
+            )
+        ]
+    
+    def _append_row(self, bus_id: str) -> int:
+        """Add a row for a new bus, doubling the numeric columns when full"""
+        row = len(self.ids)
+        if row == self.capacity:
+            self._grow(self.capacity * 2)
+        
+        self.ids.append(bus_id)
+        self.idx[bus_id] = row
+        self.route_id.append("")
+        self.trip_id.append(None)
+        self.anomaly_types.append([])
+        self.severity.append("info")
+        return row
+    
+    def _grow(self, capacity: int):
+        """Resize the numeric columns to a new capacity"""
+        for column in ("lat", "lon", "speed", "timestamp", "bearing", "is_ghost"):
+            values = getattr(self, column)
+            resized = np.zeros(capacity, dtype=values.dtype)
+            resized[:self.capacity] = values
+            setattr(self, column, resized)
+        self.capacity = capacity
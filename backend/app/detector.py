@@ -1,15 +1,132 @@
 import time
 import math
-import statistics
 from typing import Dict, List, Tuple, Optional
 import logging
+import numpy as np
+from numba import njit
+
+from .gtfs_loader import GTFSLoader
 
 logger = logging.getLogger(__name__)
 
+# Colorado bounds used for the simplified off-route check
+# Colorado is roughly between 37°N-41°N and 102°W-109°W
+CO_MIN_LAT, CO_MAX_LAT, CO_MIN_LON, CO_MAX_LON = CO_BOUNDS = (37.0, 41.0, -109.0, -102.0)
+
+def off_route_mask(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    """Flag positions outside the Colorado bounds, for a whole batch at once"""
+    # Written as "not inside" so NaN coordinates count as off-route
+    return ~((lat >= CO_MIN_LAT) & (lat <= CO_MAX_LAT) & (lon >= CO_MIN_LON) & (lon <= CO_MAX_LON))
+
+@njit(cache=True, fastmath=True)
+def haversine_sum(lat_rad: np.ndarray, lon_rad: np.ndarray) -> float:
+    """Total haversine length in meters of a track given in radians, in one fused loop"""
+    R = 6371000.0  # Earth's radius in meters
+    total = 0.0
+    
+    for i in range(1, lat_rad.shape[0]):
+        lat1 = lat_rad[i-1]
+        lat2 = lat_rad[i]
+        dlat = lat2 - lat1
+        dlon = lon_rad[i] - lon_rad[i-1]
+        
+        # sin²(x/2) as (1 - cos(x))/2 trades a sin and a square for a cos and a
+        # subtraction; the transcendental count is the same. 1 - cos(x) cancels
+        # for tiny angles, so sub-meter steps (a parked bus's GPS jitter) are off
+        # by several percent with fastmath. Fine for total track length, not for
+        # judging individual steps.
+        a = ((1 - math.cos(dlat))/2 +
+             math.cos(lat1) * math.cos(lat2) *
+             (1 - math.cos(dlon))/2)
+        total += 2 * R * math.asin(math.sqrt(a))
+    
+    return total
+
+class BusRing:
+    """Fixed-size ring buffer holding a bus's recent positions as parallel arrays"""
+    
+    def __init__(self, capacity: int = 60):
+        self.capacity = capacity
+        self.lat = np.empty(capacity)
+        self.lon = np.empty(capacity)
+        self.lat_rad = np.empty(capacity)  # Converted once on push for the distance kernels
+        self.lon_rad = np.empty(capacity)
+        self.timestamp = np.empty(capacity)
+        self.speed = np.empty(capacity)  # NaN where no speed was reported
+        self.head = 0  # Next slot to write
+        self.count = 0
+        
+        # Running totals over the reported speeds in the window
+        self.speed_sum = 0.0
+        self.speed_count = 0
+    
+    def __len__(self) -> int:
+        return self.count
+    
+    def push(self, lat: float, lon: float, timestamp: float, speed: Optional[float]):
+        """Write a reading into the next slot, overwriting the oldest when full"""
+        slot = self.head
+        
+        # Evict the oldest speed from the running totals
+        if self.count == self.capacity:
+            evicted = float(self.speed[slot])
+            if not math.isnan(evicted):
+                self.speed_sum -= evicted
+                self.speed_count -= 1
+        
+        if speed is None:
+            speed = math.nan
+        else:
+            self.speed_sum += speed
+            self.speed_count += 1
+        
+        self.lat[slot] = lat
+        self.lon[slot] = lon
+        self.lat_rad[slot] = math.radians(lat)
+        self.lon_rad[slot] = math.radians(lon)
+        self.timestamp[slot] = timestamp
+        self.speed[slot] = speed
+        
+        self.head = (slot + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+    
+    def mean_speed(self) -> Optional[float]:
+        """Get the average reported speed over the window in O(1)"""
+        if not self.speed_count:
+            return None
+        return self.speed_sum / self.speed_count
+    
+    def recent(self, n: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Get the last n readings in chronological order as (lat, lon, timestamp, speed)"""
+        n = min(n, self.count)
+        return (
+            self._window(self.lat, n),
+            self._window(self.lon, n),
+            self._window(self.timestamp, n),
+            self._window(self.speed, n)
+        )
+    
+    def recent_radians(self, n: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Get the last n positions in chronological order as (lat_rad, lon_rad)"""
+        n = min(n, self.count)
+        return self._window(self.lat_rad, n), self._window(self.lon_rad, n)
+    
+    def _window(self, values: np.ndarray, n: int) -> np.ndarray:
+        """Slice the last n values, only copying when the window wraps around"""
+        start = (self.head - n) % self.capacity
+        end = start + n
+        if end <= self.capacity:
+            return values[start:end]
+        return np.concatenate((values[start:], values[:end - self.capacity]))
+
 class GhostBusDetector:
     """Detects ghost buses using various anomaly detection rules"""
     
-    def __init__(self):
+    def __init__(self, gtfs_loader: Optional[GTFSLoader] = None):
+        # GTFS data used to locate stops (stationary checks ignore stops if missing)
+        self.gtfs_loader = gtfs_loader
+        
         # Detection thresholds
         self.stale_threshold = 120  # 2 minutes
         self.stationary_threshold = 60  # 1 minute
@@ -18,67 +135,116 @@ class GhostBusDetector:
         self.stop_buffer = 50  # meters around stops
         
         # Historical data storage (in-memory for simplicity)
-        self.position_history: Dict[str, List[Dict]] = {}
-        self.speed_history: Dict[str, List[float]] = {}
+        self.position_history: Dict[str, BusRing] = {}
         self.max_history_length = 60  # Keep last 60 readings
     
-    def detect_anomalies(self, bus_data: Dict) -> Tuple[bool, List[str], str]:
+    def detect_anomalies(self, bus_data: Dict, now: Optional[float] = None) -> Tuple[bool, List[str], str]:
         """
-        Detect anomalies in bus data
+        Record a bus update and detect anomalies in it.
+        Stale or off-route updates are already known to be ghosts, so they
+        return early without touching the history or the rolling-window checks.
+        `now` lets callers share one clock reading across a tick (defaults to time.time()).
         Returns: (is_ghost, anomaly_types, severity)
         """
-        bus_id = bus_data.get("id", "")
-        current_time = time.time()
+        if now is None:
+            now = time.time()
+        
+        anomaly_types = self._detect_fast_anomalies(bus_data, now)
+        if anomaly_types:
+            return self._build_result(anomaly_types)
         
+        # The fast checks already passed, so only the history checks remain
+        self.ingest(bus_data, now)
+        return self._build_result(self._detect_history_anomalies(bus_data))
+    
+    def ingest(self, bus_data: Dict, now: Optional[float] = None):
+        """Record a bus update in the position and speed history"""
+        self._store_position_history(bus_data.get("id", ""), bus_data, now)
+    
+    def detect_anomalies_batch(self, buses: List[Dict], now: Optional[float] = None) -> List[Tuple[bool, List[str], str]]:
+        """
+        Record and detect anomalies for a whole tick of bus updates at once.
+        The stale and off-route checks run as vector operations over the batch;
+        only buses passing them are ingested and checked against their history.
+        Returns: one (is_ghost, anomaly_types, severity) per bus, in order
+        """
+        if not buses:
+            return []
+        
+        current_time = now if now is not None else time.time()
+        lat = np.array([bus_data.get("lat", 0) for bus_data in buses], dtype=float)
+        lon = np.array([bus_data.get("lon", 0) for bus_data in buses], dtype=float)
+        timestamp = np.array([bus_data.get("timestamp", current_time) for bus_data in buses], dtype=float)
+        
+        stale = (current_time - timestamp) > self.stale_threshold
+        off_route = off_route_mask(lat, lon)
+        
+        results = []
+        for bus_data, is_stale, is_off_route in zip(buses, stale.tolist(), off_route.tolist()):
+            if is_stale or is_off_route:
+                anomaly_types = ["stale_data"] if is_stale else []
+                if is_off_route:
+                    anomaly_types.append("off_route")
+            else:
+                self.ingest(bus_data, current_time)
+                anomaly_types = self._detect_history_anomalies(bus_data)
+            results.append(self._build_result(anomaly_types))
+        
+        return results
+    
+    def _build_result(self, anomaly_types: List[str]) -> Tuple[bool, List[str], str]:
+        """Build the (is_ghost, anomaly_types, severity) detection result"""
+        # A bus with any anomaly is considered a ghost
+        is_ghost = len(anomaly_types) > 0
+        return is_ghost, anomaly_types, self._calculate_severity(anomaly_types)
+    
+    def _detect_fast_anomalies(self, bus_data: Dict, now: float) -> List[str]:
+        """Run the checks that need no history: stale data and off-route"""
         anomaly_types = []
         
-        # 1. Stale data detection
-        last_update = bus_data.get("timestamp", current_time)
-        if current_time - last_update > self.stale_threshold:
+        # Stale data detection
+        last_update = bus_data.get("timestamp", now)
+        if now - last_update > self.stale_threshold:
             anomaly_types.append("stale_data")
         
-        # 2. Store position history
-        self._store_position_history(bus_id, bus_data)
+        # Off-route detection (simplified - would need route geometry)
+        # For now, just check if bus is in a reasonable area
+        if self._is_off_route(bus_data):
+            anomaly_types.append("off_route")
+        
+        return anomaly_types
+    
+    def _detect_history_anomalies(self, bus_data: Dict) -> List[str]:
+        """Run the checks against the recorded history: stationary and speed anomalies"""
+        bus_id = bus_data.get("id", "")
+        anomaly_types = []
         
-        # 3. Non-moving detection
+        # Non-moving detection
         if self._is_stationary_at_non_stop(bus_id, bus_data):
             anomaly_types.append("stationary_non_stop")
         
-        # 4. Speed anomaly detection
+        # Speed anomaly detection
         speed_anomaly = self._detect_speed_anomaly(bus_id, bus_data.get("speed"))
         if speed_anomaly:
             anomaly_types.append(speed_anomaly)
         
-        # 5. Off-route detection (simplified - would need route geometry)
-        # For now, just check if bus is in a reasonable area
-        if self._is_off_route(bus_data):
-            anomaly_types.append("off_route")
-        
-        # Determine if it's a ghost bus
-        is_ghost = len(anomaly_types) > 0
-        
-        # Determine severity
-        severity = self._calculate_severity(anomaly_types)
-        
-        return is_ghost, anomaly_types, severity
+        return anomaly_types
     
-    def _store_position_history(self, bus_id: str, bus_data: Dict):
+    def _store_position_history(self, bus_id: str, bus_data: Dict, now: Optional[float] = None):
         """Store position history for movement analysis"""
         if bus_id not in self.position_history:
-            self.position_history[bus_id] = []
-        
-        position_entry = {
-            "lat": bus_data.get("lat", 0),
-            "lon": bus_data.get("lon", 0),
-            "timestamp": bus_data.get("timestamp", time.time()),
-            "speed": bus_data.get("speed", 0)
-        }
-        
-        self.position_history[bus_id].append(position_entry)
-        
-        # Keep only recent history
-        if len(self.position_history[bus_id]) > self.max_history_length:
-            self.position_history[bus_id] = self.position_history[bus_id][-self.max_history_length:]
+            self.position_history[bus_id] = BusRing(self.max_history_length)
+        
+        timestamp = bus_data.get("timestamp")
+        if timestamp is None:
+            timestamp = now if now is not None else time.time()
+        
+        self.position_history[bus_id].push(
+            bus_data.get("lat", 0),
+            bus_data.get("lon", 0),
+            timestamp,
+            bus_data.get("speed")
+        )
     
     def _is_stationary_at_non_stop(self, bus_id: str, bus_data: Dict) -> bool:
         """Check if bus is stationary at a non-stop location"""
@@ -89,54 +255,41 @@ class GhostBusDetector:
         if len(history) < 3:
             return False
         
-        # Check if bus hasn't moved much in recent history
-        recent_positions = history[-5:]  # Last 5 positions
-        if len(recent_positions) < 3:
-            return False
+        # Check if bus hasn't moved much in recent history (last 5 positions)
+        lat_rad, lon_rad = history.recent_radians(5)
+        _, _, timestamps, _ = history.recent(5)
         
-        # Calculate total distance moved
-        total_distance = 0
-        for i in range(1, len(recent_positions)):
-            distance = self._haversine_distance(
-                recent_positions[i-1]["lat"], recent_positions[i-1]["lon"],
-                recent_positions[i]["lat"], recent_positions[i]["lon"]
-            )
-            total_distance += distance
+        # Calculate total distance moved (flat-earth is accurate at these scales)
+        total_distance = self._equirect_vector(lat_rad, lon_rad).sum()
         
         # Check time span
-        time_span = recent_positions[-1]["timestamp"] - recent_positions[0]["timestamp"]
+        time_span = timestamps[-1] - timestamps[0]
         
         # If moved less than 20 meters in more than 1 minute, consider stationary
         if total_distance < 20 and time_span > self.stationary_threshold:
-            # Check if near a bus stop (simplified - would need GTFS stops data)
-            # For now, assume not near stop if in the middle of coordinates
-            lat, lon = bus_data.get("lat", 0), bus_data.get("lon", 0)
-            # This is a simplified check - in real implementation, use GTFS stops
-            return True
+            # Dwelling at a stop is expected, only flag buses stopped elsewhere
+            return not self._is_near_stop(bus_data.get("lat", 0), bus_data.get("lon", 0))
         
         return False
     
+    def _is_near_stop(self, lat: float, lon: float) -> bool:
+        """Check if a position is within the stop buffer of a GTFS stop"""
+        if self.gtfs_loader is None:
+            return False
+        
+        return self.gtfs_loader.nearest_stop_distance(lat, lon) <= self.stop_buffer
+    
     def _detect_speed_anomaly(self, bus_id: str, current_speed: Optional[float]) -> Optional[str]:
         """Detect speed anomalies"""
         if current_speed is None:
             return None
         
-        # Store speed history
-        if bus_id not in self.speed_history:
-            self.speed_history[bus_id] = []
-        
-        self.speed_history[bus_id].append(current_speed)
-        
-        # Keep only recent history
-        if len(self.speed_history[bus_id]) > self.max_history_length:
-            self.speed_history[bus_id] = self.speed_history[bus_id][-self.max_history_length:]
-        
         # Need at least 5 readings for analysis
-        if len(self.speed_history[bus_id]) < 5:
+        history = self.position_history.get(bus_id)
+        if history is None or history.speed_count < 5:
             return None
         
-        speeds = self.speed_history[bus_id]
-        avg_speed = statistics.mean(speeds)
+        avg_speed = history.mean_speed()
         
         # Speed spike detection
         if avg_speed > 0 and current_speed > avg_speed * 3:
@@ -153,8 +306,7 @@ class GhostBusDetector:
         lat, lon = bus_data.get("lat", 0), bus_data.get("lon", 0)
         
         # Colorado bounds check (very simplified)
-        # Colorado is roughly between 37°N-41°N and 102°W-109°W
-        if not (37.0 <= lat <= 41.0 and -109.0 <= lon <= -102.0):
+        if not (CO_MIN_LAT <= lat <= CO_MAX_LAT and CO_MIN_LON <= lon <= CO_MAX_LON):
             return True
         
         return False
@@ -172,6 +324,16 @@ class GhostBusDetector:
         
         return 2 * R * math.asin(math.sqrt(a))
     
+    def _equirect_vector(self, lat_rad: np.ndarray, lon_rad: np.ndarray) -> np.ndarray:
+        """Approximate distances in meters between consecutive points of a short track in radians"""
+        R = 6371000  # Earth's radius in meters
+        
+        # Longitude scale is taken once at the start of the track
+        dy = R * np.diff(lat_rad)
+        dx = R * math.cos(lat_rad[0]) * np.diff(lon_rad)
+        
+        return np.sqrt(dx*dx + dy*dy)
+    
     def _calculate_severity(self, anomaly_types: List[str]) -> str:
         """Calculate severity based on anomaly types"""
         if not anomaly_types:
@@ -187,29 +349,23 @@ class GhostBusDetector:
         else:
             return "info"
     
+    def warmup(self):
+        """Compile the numeric kernels ahead of the first request"""
+        haversine_sum(np.zeros(2), np.zeros(2))
+    
     def get_bus_statistics(self, bus_id: str) -> Dict:
         """Get statistics for a specific bus"""
+        history = self.position_history.get(bus_id)
         stats = {
-            "position_history_count": len(self.position_history.get(bus_id, [])),
-            "speed_history_count": len(self.speed_history.get(bus_id, [])),
-            "avg_speed": None,
+            "position_history_count": len(history) if history else 0,
+            "speed_history_count": history.speed_count if history else 0,
+            "avg_speed": history.mean_speed() if history else None,
             "total_distance": 0
         }
         
-        # Calculate average speed
-        if bus_id in self.speed_history and self.speed_history[bus_id]:
-            stats["avg_speed"] = statistics.mean(self.speed_history[bus_id])
-        
         # Calculate total distance traveled
-        if bus_id in self.position_history and len(self.position_history[bus_id]) > 1:
-            positions = self.position_history[bus_id]
-            total_distance = 0
-            for i in range(1, len(positions)):
-                distance = self._haversine_distance(
-                    positions[i-1]["lat"], positions[i-1]["lon"],
-                    positions[i]["lat"], positions[i]["lon"]
-                )
-                total_distance += distance
-            stats["total_distance"] = total_distance
+        if history and len(history) > 1:
+            lat_rad, lon_rad = history.recent_radians(len(history))
+            stats["total_distance"] = haversine_sum(lat_rad, lon_rad)
         
         return stats
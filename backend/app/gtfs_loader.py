@@ -1,11 +1,91 @@
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+from pyarrow import csv as pa_csv
+from scipy.spatial import cKDTree
+import math
 import os
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional
 import logging
 from pathlib import Path
 
 logger = logging.getLogger(__name__)
 
+EARTH_RADIUS = 6371000  # meters
+
+# Columns exposed by the getters, with the default used for missing values.
+# The type of each default is the type the column is cast to at load time.
+# Coordinates stay float64 so exported values match the source feed.
+ROUTE_COLUMNS = {
+    'route_id': '',
+    'route_short_name': '',
+    'route_long_name': '',
+    'route_type': 3,  # Default to bus
+    'route_color': 'FFFFFF',
+    'route_text_color': '000000'
+}
+
+STOP_COLUMNS = {
+    'stop_id': '',
+    'stop_name': '',
+    'stop_lat': 0.0,
+    'stop_lon': 0.0,
+    'stop_code': '',
+    'stop_desc': '',
+    'zone_id': '',
+    'stop_url': '',
+    'location_type': 0,
+    'parent_station': ''
+}
+
+TRIP_COLUMNS = {
+    'trip_id': '',
+    'route_id': '',
+    'service_id': '',
+    'trip_headsign': '',
+    'trip_short_name': '',
+    'direction_id': 0,
+    'block_id': '',
+    'shape_id': ''
+}
+
+STOP_TIME_COLUMNS = {
+    'trip_id': '',
+    'arrival_time': '',
+    'departure_time': '',
+    'stop_id': '',
+    'stop_sequence': 0,
+    'stop_headsign': '',
+    'pickup_type': 0,
+    'drop_off_type': 0,
+    'shape_dist_traveled': 0.0
+}
+
+SHAPE_COLUMNS = {
+    'shape_id': '',
+    'shape_pt_lat': 0.0,
+    'shape_pt_lon': 0.0,
+    'shape_pt_sequence': 0,
+    'shape_dist_traveled': 0.0
+}
+
+# Subset of stop columns returned when looking up a single stop
+STOP_LOOKUP_FIELDS = ['stop_id', 'stop_name', 'stop_lat', 'stop_lon', 'stop_code', 'stop_desc']
+
+# Text columns declared up front for the CSV reader so IDs like "000000" keep
+# their format. Numeric columns are left to inference, since feeds write values
+# like "3.0" in integer fields; _prepare_columns coerces and casts them.
+GTFS_SCHEMAS = {
+    filename: {column: pa.string() for column, default in columns.items() if isinstance(default, str)}
+    for filename, columns in [
+        ("routes.txt", ROUTE_COLUMNS),
+        ("stops.txt", STOP_COLUMNS),
+        ("trips.txt", TRIP_COLUMNS),
+        ("stop_times.txt", STOP_TIME_COLUMNS),
+        ("shapes.txt", SHAPE_COLUMNS)
+    ]
+}
+
 class GTFSLoader:
     """Loads and processes GTFS (General Transit Feed Specification) data files."""
     
@@ -28,6 +108,17 @@ class GTFSLoader:
         self.fare_attributes = pd.DataFrame()
         self.fare_rules = pd.DataFrame()
         
+        # Lookup indexes built once at load time
+        self._routes_by_id: Dict[str, Dict] = {}
+        self._stops_by_id: Dict[str, Dict] = {}
+        self._trips_by_route: Dict[str, np.ndarray] = {}
+        self._stop_times_by_trip: Dict[str, np.ndarray] = {}
+        self._shapes_by_id: Dict[str, np.ndarray] = {}
+        
+        # Spatial index of stops on an equirectangular projection (meters)
+        self.stop_tree: Optional[cKDTree] = None
+        self._stop_lon_scale = 1.0
+        
     def load_all(self) -> bool:
         """
         Load all GTFS files.
@@ -54,6 +145,16 @@ class GTFSLoader:
             self.fare_attributes = self._load_file("fare_attributes.txt", required=False)
             self.fare_rules = self._load_file("fare_rules.txt", required=False)
             
+            # Cast columns once so the getters can export them without per-row work
+            self.routes = self._prepare_columns(self.routes, ROUTE_COLUMNS)
+            self.stops = self._prepare_columns(self.stops, STOP_COLUMNS)
+            self.trips = self._prepare_columns(self.trips, TRIP_COLUMNS)
+            self.stop_times = self._prepare_columns(self.stop_times, STOP_TIME_COLUMNS)
+            self.shapes = self._prepare_columns(self.shapes, SHAPE_COLUMNS)
+            
+            self._build_indexes()
+            self._build_stop_tree()
+            
             # Log loaded data statistics
             logger.info(f"Loaded {len(self.routes)} routes")
             logger.info(f"Loaded {len(self.stops)} stops")
@@ -90,11 +191,20 @@ class GTFSLoader:
                 return pd.DataFrame()
         
         try:
-            # Load with error handling for different encodings
+            # Load with the multi-threaded Arrow reader, falling back to latin-1
+            # only when the file isn't valid UTF-8
             try:
-                df = pd.read_csv(file_path, encoding='utf-8')
-            except UnicodeDecodeError:
-                df = pd.read_csv(file_path, encoding='latin-1')
+                table = self._read_csv(file_path, 'utf8')
+            except pa.ArrowInvalid as e:
+                if 'UTF8' not in str(e):
+                    raise
+                table = None
+            
+            # Undeclared columns with invalid UTF-8 are inferred as binary rather than failing
+            if table is None or any(pa.types.is_binary(field.type) for field in table.schema):
+                table = self._read_csv(file_path, 'latin-1')
+            
+            df = table.to_pandas()
             
             logger.debug(f"Loaded {filename}: {len(df)} records")
             return df
@@ -106,151 +216,178 @@ class GTFSLoader:
                 logger.warning(f"Error loading optional file {filename}: {e}")
                 return pd.DataFrame()
     
+    def _read_csv(self, file_path: Path, encoding: str) -> pa.Table:
+        """
+        Parse a GTFS file with pyarrow using its declared text columns.
+        
+        Args:
+            file_path: Path to the GTFS file
+            encoding: Text encoding of the file
+            
+        Returns:
+            pa.Table: Parsed data
+        """
+        convert_options = pa_csv.ConvertOptions(
+            column_types=GTFS_SCHEMAS.get(file_path.name, {}),
+            strings_can_be_null=True
+        )
+        return pa_csv.read_csv(
+            file_path,
+            read_options=pa_csv.ReadOptions(encoding=encoding),
+            convert_options=convert_options
+        )
+    
+    def _prepare_columns(self, df: pd.DataFrame, columns: Dict[str, Any]) -> pd.DataFrame:
+        """
+        Add missing columns, fill missing values and cast each column to the type of its default.
+        
+        Args:
+            df: Loaded GTFS data
+            columns: Mapping of column name to default value
+            
+        Returns:
+            pd.DataFrame: Data with every column in `columns` present and typed
+        """
+        if df.empty:
+            return df
+        
+        df = df.copy()
+        for column, default in columns.items():
+            if column not in df.columns:
+                df[column] = default
+            elif isinstance(default, str):
+                df[column] = df[column].fillna(default).astype(str)
+            else:
+                values = pd.to_numeric(df[column], errors='coerce').fillna(default)
+                df[column] = values.astype(type(default))
+        
+        return df
+    
+    def _build_indexes(self):
+        """
+        Build lookup tables so that getters by ID avoid scanning whole DataFrames.
+        
+        Routes and stops are indexed to their exported records. Trips, stop times
+        and shapes are indexed to the row positions of each group, with rows
+        pre-sorted by sequence so each group is already in order.
+        """
+        self._routes_by_id = {}
+        if not self.routes.empty:
+            routes = self.routes.drop_duplicates('route_id')
+            self._routes_by_id = dict(zip(routes['route_id'], routes[list(ROUTE_COLUMNS)].to_dict(orient='records')))
+        
+        self._stops_by_id = {}
+        if not self.stops.empty:
+            stops = self.stops.drop_duplicates('stop_id')
+            self._stops_by_id = dict(zip(stops['stop_id'], stops[STOP_LOOKUP_FIELDS].to_dict(orient='records')))
+        
+        if not self.stop_times.empty:
+            self.stop_times = self.stop_times.sort_values('stop_sequence', kind='stable', ignore_index=True)
+        if not self.shapes.empty:
+            self.shapes = self.shapes.sort_values('shape_pt_sequence', kind='stable', ignore_index=True)
+        
+        self._trips_by_route = self._group_positions(self.trips, 'route_id')
+        self._stop_times_by_trip = self._group_positions(self.stop_times, 'trip_id')
+        self._shapes_by_id = self._group_positions(self.shapes, 'shape_id')
+    
+    def _group_positions(self, df: pd.DataFrame, column: str) -> Dict[str, np.ndarray]:
+        """Map each value of a column to the row positions holding it."""
+        if df.empty:
+            return {}
+        
+        return df.groupby(column, sort=False).indices
+    
+    def _build_stop_tree(self):
+        """
+        Build a KD-tree over stop coordinates for nearest-stop queries.
+        
+        Stops are projected equirectangularly around the feed's mean latitude,
+        which is accurate enough for the short distances being compared.
+        """
+        self.stop_tree = None
+        if self.stops.empty:
+            return
+        
+        # Skip stops without coordinates (filled with 0.0 at load time)
+        located = self.stops[(self.stops['stop_lat'] != 0.0) | (self.stops['stop_lon'] != 0.0)]
+        if located.empty:
+            return
+        
+        lat = np.radians(located['stop_lat'].to_numpy())
+        lon = np.radians(located['stop_lon'].to_numpy())
+        self._stop_lon_scale = math.cos(lat.mean())
+        
+        xy = np.column_stack((lat * EARTH_RADIUS, lon * self._stop_lon_scale * EARTH_RADIUS))
+        self.stop_tree = cKDTree(xy)
+    
+    def nearest_stop_distance(self, lat: float, lon: float) -> float:
+        """
+        Get the distance from a point to the nearest stop.
+        
+        Args:
+            lat: Latitude of the point
+            lon: Longitude of the point
+            
+        Returns:
+            float: Distance in meters, or infinity if no stops are loaded
+        """
+        if self.stop_tree is None:
+            return math.inf
+        
+        point = (
+            math.radians(lat) * EARTH_RADIUS,
+            math.radians(lon) * self._stop_lon_scale * EARTH_RADIUS
+        )
+        distance, _ = self.stop_tree.query(point)
+        return float(distance)
+    
     def get_routes(self) -> List[Dict]:
         """Get all routes as list of dictionaries."""
         if self.routes.empty:
             return []
         
-        routes = []
-        for _, route in self.routes.iterrows():
-            routes.append({
-                'route_id': route.get('route_id', ''),
-                'route_short_name': route.get('route_short_name', ''),
-                'route_long_name': route.get('route_long_name', ''),
-                'route_type': route.get('route_type', 3),  # Default to bus
-                'route_color': route.get('route_color', 'FFFFFF'),
-                'route_text_color': route.get('route_text_color', '000000')
-            })
-        
-        return routes
+        return self.routes[list(ROUTE_COLUMNS)].to_dict(orient='records')
     
     def get_stops(self) -> List[Dict]:
         """Get all stops as list of dictionaries."""
         if self.stops.empty:
             return []
         
-        stops = []
-        for _, stop in self.stops.iterrows():
-            try:
-                stops.append({
-                    'stop_id': str(stop.get('stop_id', '')),
-                    'stop_name': str(stop.get('stop_name', '')),
-                    'stop_lat': float(stop.get('stop_lat', 0.0)) if pd.notna(stop.get('stop_lat')) else 0.0,
-                    'stop_lon': float(stop.get('stop_lon', 0.0)) if pd.notna(stop.get('stop_lon')) else 0.0,
-                    'stop_code': str(stop.get('stop_code', '')),
-                    'stop_desc': str(stop.get('stop_desc', '')),
-                    'zone_id': str(stop.get('zone_id', '')),
-                    'stop_url': str(stop.get('stop_url', '')),
-                    'location_type': int(stop.get('location_type', 0)) if pd.notna(stop.get('location_type')) else 0,
-                    'parent_station': str(stop.get('parent_station', ''))
-                })
-            except Exception as e:
-                logger.error(f"Error processing stop {stop.get('stop_id', 'unknown')}: {e}")
-                continue
-        
-        return stops
+        return self.stops[list(STOP_COLUMNS)].to_dict(orient='records')
     
     def get_trips_for_route(self, route_id: str) -> List[Dict]:
         """Get all trips for a specific route."""
-        if self.trips.empty:
+        positions = self._trips_by_route.get(route_id)
+        if positions is None:
             return []
         
-        route_trips = self.trips[self.trips['route_id'] == route_id]
-        
-        trips = []
-        for _, trip in route_trips.iterrows():
-            trips.append({
-                'trip_id': trip.get('trip_id', ''),
-                'route_id': trip.get('route_id', ''),
-                'service_id': trip.get('service_id', ''),
-                'trip_headsign': trip.get('trip_headsign', ''),
-                'trip_short_name': trip.get('trip_short_name', ''),
-                'direction_id': int(trip.get('direction_id', 0)),
-                'block_id': trip.get('block_id', ''),
-                'shape_id': trip.get('shape_id', '')
-            })
-        
-        return trips
+        return self.trips.iloc[positions][list(TRIP_COLUMNS)].to_dict(orient='records')
     
     def get_stop_times_for_trip(self, trip_id: str) -> List[Dict]:
         """Get all stop times for a specific trip."""
-        if self.stop_times.empty:
+        positions = self._stop_times_by_trip.get(trip_id)
+        if positions is None:
             return []
         
-        trip_stop_times = self.stop_times[self.stop_times['trip_id'] == trip_id].sort_values('stop_sequence')
-        
-        stop_times = []
-        for _, stop_time in trip_stop_times.iterrows():
-            stop_times.append({
-                'trip_id': stop_time.get('trip_id', ''),
-                'arrival_time': stop_time.get('arrival_time', ''),
-                'departure_time': stop_time.get('departure_time', ''),
-                'stop_id': stop_time.get('stop_id', ''),
-                'stop_sequence': int(stop_time.get('stop_sequence', 0)),
-                'stop_headsign': stop_time.get('stop_headsign', ''),
-                'pickup_type': int(stop_time.get('pickup_type', 0)),
-                'drop_off_type': int(stop_time.get('drop_off_type', 0)),
-                'shape_dist_traveled': float(stop_time.get('shape_dist_traveled', 0.0))
-            })
-        
-        return stop_times
+        return self.stop_times.iloc[positions][list(STOP_TIME_COLUMNS)].to_dict(orient='records')
     
     def get_shape_points(self, shape_id: str) -> List[Dict]:
         """Get all shape points for a specific shape."""
-        if self.shapes.empty or not shape_id:
+        positions = self._shapes_by_id.get(shape_id)
+        if positions is None:
             return []
         
-        shape_points = self.shapes[self.shapes['shape_id'] == shape_id].sort_values('shape_pt_sequence')
-        
-        points = []
-        for _, point in shape_points.iterrows():
-            points.append({
-                'shape_id': point.get('shape_id', ''),
-                'shape_pt_lat': float(point.get('shape_pt_lat', 0.0)),
-                'shape_pt_lon': float(point.get('shape_pt_lon', 0.0)),
-                'shape_pt_sequence': int(point.get('shape_pt_sequence', 0)),
-                'shape_dist_traveled': float(point.get('shape_dist_traveled', 0.0))
-            })
-        
-        return points
+        return self.shapes.iloc[positions][list(SHAPE_COLUMNS)].to_dict(orient='records')
     
     def get_route_by_id(self, route_id: str) -> Optional[Dict]:
         """Get a specific route by ID."""
-        if self.routes.empty:
-            return None
-        
-        route_data = self.routes[self.routes['route_id'] == route_id]
-        if route_data.empty:
-            return None
-        
-        route = route_data.iloc[0]
-        return {
-            'route_id': route.get('route_id', ''),
-            'route_short_name': route.get('route_short_name', ''),
-            'route_long_name': route.get('route_long_name', ''),
-            'route_type': route.get('route_type', 3),
-            'route_color': route.get('route_color', 'FFFFFF'),
-            'route_text_color': route.get('route_text_color', '000000')
-        }
+        route = self._routes_by_id.get(route_id)
+        return dict(route) if route is not None else None
     
     def get_stop_by_id(self, stop_id: str) -> Optional[Dict]:
         """Get a specific stop by ID."""
-        if self.stops.empty:
-            return None
-        
-        stop_data = self.stops[self.stops['stop_id'] == stop_id]
-        if stop_data.empty:
-            return None
-        
-        stop = stop_data.iloc[0]
-        return {
-            'stop_id': stop.get('stop_id', ''),
-            'stop_name': stop.get('stop_name', ''),
-            'stop_lat': float(stop.get('stop_lat', 0.0)),
-            'stop_lon': float(stop.get('stop_lon', 0.0)),
-            'stop_code': stop.get('stop_code', ''),
-            'stop_desc': stop.get('stop_desc', '')
-        }
+        stop = self._stops_by_id.get(stop_id)
+        return dict(stop) if stop is not None else None
     
     def is_loaded(self) -> bool:
         """Check if GTFS data has been loaded."""
@@ -1,10 +1,10 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse
 import asyncio
 import json
 import logging
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple
 import uvicorn
 
 from .models import BusUpdate, BusStatus, FilterRequest
@@ -12,12 +12,13 @@ from .gtfs_loader import GTFSLoader
 from .detector import GhostBusDetector
 from .storage import RedisStorage
 from .websocket_manager import ConnectionManager
+from .bus_table import ActiveBusTable
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Ghost Bus Detector API", version="1.0.0")
+app = FastAPI(title="Ghost Bus Detector API", version="1.0.0", default_response_class=ORJSONResponse)
 
 # CORS middleware
 app.add_middleware(
@@ -30,12 +31,45 @@ app.add_middleware(
 
 # Global instances
 gtfs_loader = GTFSLoader("../")  # Path to GTFS files
-detector = GhostBusDetector()
+detector = GhostBusDetector(gtfs_loader)
 storage = RedisStorage()
 manager = ConnectionManager()
 
-# Store active buses
-active_buses: Dict[str, BusUpdate] = {}
+# Store active buses with their latest ghost detection results, kept in
+# columns and updated when each update is ingested so that reads never
+# touch the detector history
+active_buses = ActiveBusTable()
+
+def ingest_bus_update(bus_id: str, bus_dict: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Record a bus update, run ghost detection once and return the bus data.
+    `bus_dict` is the update's model_dump(), shared with the other consumers.
+    """
+    result = detector.detect_anomalies(bus_dict)
+    active_buses.upsert(bus_id, bus_dict, result)
+    return build_bus_data(bus_dict, result)
+
+def ingest_bus_updates(bus_dicts: List[Dict[str, Any]], now: float) -> List[Dict[str, Any]]:
+    """Record a tick of bus updates, classify them as one batch at `now` and return the bus data"""
+    results = detector.detect_anomalies_batch(bus_dicts, now)
+    
+    for bus_dict, result in zip(bus_dicts, results):
+        active_buses.upsert(bus_dict["id"], bus_dict, result)
+    
+    return [build_bus_data(bus_dict, result) for bus_dict, result in zip(bus_dicts, results)]
+
+def build_bus_data(bus_dict: Dict[str, Any], result: Tuple[bool, List[str], str]) -> Dict[str, Any]:
+    """Combine a dumped bus update with its detection results"""
+    is_ghost, anomaly_types, severity = result
+    
+    bus_data = dict(bus_dict)
+    bus_data.update({
+        "is_ghost": is_ghost,
+        "anomaly_types": anomaly_types,
+        "severity": severity,
+        "status": "ghost" if is_ghost else "active"
+    })
+    return bus_data
 
 @app.on_event("startup")
 async def startup_event():
@@ -45,12 +79,18 @@ async def startup_event():
         logger.info("Loading GTFS data...")
         gtfs_loader.load_all()
         
+        # Compile detector kernels before the simulator starts
+        detector.warmup()
+        
         # Initialize Redis connection
         await storage.connect()
         
         # Start the bus simulator
         asyncio.create_task(bus_simulator())
         
+        # Start the periodic Redis cleanup
+        asyncio.create_task(redis_cleanup())
+        
         logger.info("Application started successfully")
     except Exception as e:
         logger.error(f"Failed to start application: {e}")
@@ -89,90 +129,50 @@ async def get_stops():
 @app.get("/buses")
 async def get_all_buses():
     """Get all active buses with their current status"""
-    buses_data = []
-    for bus_id, bus in active_buses.items():
-        # Get ghost detection results
-        is_ghost, anomaly_types, severity = detector.detect_anomalies(bus.dict())
-        
-        bus_data = bus.dict()
-        bus_data.update({
-            "is_ghost": is_ghost,
-            "anomaly_types": anomaly_types,
-            "severity": severity,
-            "status": "ghost" if is_ghost else "active"
-        })
-        buses_data.append(bus_data)
+    buses_data = active_buses.to_records()
     
     return {"buses": buses_data, "total": len(buses_data)}
 
 @app.get("/buses/{bus_id}")
 async def get_bus(bus_id: str):
     """Get specific bus information"""
-    if bus_id not in active_buses:
+    bus_data = active_buses.get(bus_id)
+    if bus_data is None:
         raise HTTPException(status_code=404, detail="Bus not found")
     
-    bus = active_buses[bus_id]
-    is_ghost, anomaly_types, severity = detector.detect_anomalies(bus.dict())
-    
-    bus_data = bus.dict()
-    bus_data.update({
-        "is_ghost": is_ghost,
-        "anomaly_types": anomaly_types,
-        "severity": severity,
-        "status": "ghost" if is_ghost else "active"
-    })
-    
     return bus_data
 
 @app.post("/buses/{bus_id}/update")
 async def update_bus_position(bus_id: str, update: BusUpdate):
     """Update bus position (for testing)"""
-    active_buses[bus_id] = update
-    
-    # Store in Redis
-    await storage.store_bus_position(bus_id, update.dict())
+    bus_dict = update.model_dump()
     
     # Detect anomalies
-    is_ghost, anomaly_types, severity = detector.detect_anomalies(update.dict())
-    
-    # Broadcast update
-    bus_data = update.dict()
-    bus_data.update({
-        "is_ghost": is_ghost,
-        "anomaly_types": anomaly_types,
-        "severity": severity,
-        "status": "ghost" if is_ghost else "active"
-    })
+    bus_data = ingest_bus_update(bus_id, bus_dict)
     
-    await manager.broadcast({
-        "type": "bus_update",
-        "data": bus_data
-    })
+    # Store and publish in Redis and broadcast the update concurrently
+    await asyncio.gather(
+        storage.record_and_publish(bus_id, bus_dict),
+        manager.broadcast({
+            "type": "bus_update",
+            "data": bus_data
+        })
+    )
     
     return {"message": "Bus position updated", "bus_id": bus_id}
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     """WebSocket endpoint for real-time updates"""
-    await manager.connect(websocket)
+    # Clients opt in to msgpack frames with ?format=msgpack; JSON otherwise
+    frame_format = "msgpack" if websocket.query_params.get("format") == "msgpack" else "json"
+    await manager.connect(websocket, frame_format)
     try:
-        # Send initial snapshot
-        buses_data = []
-        for bus_id, bus in active_buses.items():
-            is_ghost, anomaly_types, severity = detector.detect_anomalies(bus.dict())
-            bus_data = bus.dict()
-            bus_data.update({
-                "is_ghost": is_ghost,
-                "anomaly_types": anomaly_types,
-                "severity": severity,
-                "status": "ghost" if is_ghost else "active"
-            })
-            buses_data.append(bus_data)
-        
-        await websocket.send_json({
-            "type": "snapshot",
-            "data": buses_data
-        })
+        # Send initial snapshot, shared by every client that connects before the next update
+        await manager.send_personal_bytes(
+            manager.snapshot_frame(active_buses.version, active_buses.to_records, frame_format),
+            websocket
+        )
         
         # Keep connection alive
         while True:
@@ -199,10 +199,14 @@ async def bus_simulator():
     
     while True:
         try:
+            # One clock reading shared by every bus in this tick
             current_time = time.time()
+            bus_updates = []
+            positions = []
             
             for i, bus_info in enumerate(test_buses):
                 bus_id = bus_info["id"]
+                route_id = bus_info["route_id"]
                 
                 # Create realistic movement for most buses
                 if bus_id != "GHOST_005":
@@ -214,50 +218,43 @@ async def bus_simulator():
                     lat = bus_info["lat"] + lat_offset
                     lon = bus_info["lon"] + lon_offset
                     speed = random.uniform(20, 60)  # km/h
-                    
-                    bus_update = BusUpdate(
-                        id=bus_id,
-                        lat=lat,
-                        lon=lon,
-                        route_id=bus_info["route_id"],
-                        speed=speed,
-                        timestamp=current_time,
-                        bearing=random.uniform(0, 360)
-                    )
+                    timestamp = current_time
+                    bearing = random.uniform(0, 360)
                 else:
                     # Ghost bus - stale data, no movement
-                    bus_update = BusUpdate(
-                        id=bus_id,
-                        lat=bus_info["lat"],
-                        lon=bus_info["lon"],
-                        route_id=bus_info["route_id"],
-                        speed=0,
-                        timestamp=current_time - 300,  # 5 minutes old
-                        bearing=0
-                    )
-                
-                # Update active buses
-                active_buses[bus_id] = bus_update
-                
-                # Store in Redis
-                await storage.store_bus_position(bus_id, bus_update.dict())
-                
-                # Detect anomalies
-                is_ghost, anomaly_types, severity = detector.detect_anomalies(bus_update.dict())
-                
-                # Broadcast update
-                bus_data = bus_update.dict()
-                bus_data.update({
-                    "is_ghost": is_ghost,
-                    "anomaly_types": anomaly_types,
-                    "severity": severity,
-                    "status": "ghost" if is_ghost else "active"
-                })
+                    lat = bus_info["lat"]
+                    lon = bus_info["lon"]
+                    speed = 0
+                    timestamp = current_time - 300  # 5 minutes old
+                    bearing = 0
                 
-                await manager.broadcast({
-                    "type": "bus_update",
-                    "data": bus_data
+                bus_updates.append(BusUpdate(
+                    id=bus_id,
+                    lat=lat,
+                    lon=lon,
+                    route_id=route_id,
+                    speed=speed,
+                    timestamp=timestamp,
+                    bearing=bearing
+                ))
+                # Storage takes the plain values, so Redis writes skip the dicts entirely
+                positions.append((bus_id, lat, lon, timestamp, speed, bearing, route_id))
+            
+            # Dump each update once and share it between detection and broadcast
+            bus_dicts = [bus_update.model_dump() for bus_update in bus_updates]
+            
+            # Update active buses and detect anomalies
+            buses_data = ingest_bus_updates(bus_dicts, current_time)
+            
+            # Store and publish the whole tick in Redis in one round-trip while
+            # broadcasting it as one message, so slow clients and Redis latency overlap
+            await asyncio.gather(
+                storage.record_and_publish_many(positions),
+                manager.broadcast({
+                    "type": "bus_batch_update",
+                    "data": buses_data
                 })
+            )
             
             await asyncio.sleep(10)  # Update every 10 seconds
             
@@ -265,5 +262,12 @@ async def bus_simulator():
             logger.error(f"Error in bus simulator: {e}")
             await asyncio.sleep(5)
 
+async def redis_cleanup():
+    """Periodically drop quiet buses from the active index and the TTL refresh times"""
+    while True:
+        await asyncio.sleep(60)  # Once a minute, well inside the 5 minute active window
+        await storage.cleanup_expired_buses()
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # "auto" picks uvloop where it is installed (not on Windows)
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="auto")
@@ -1,71 +1,271 @@
 import redis.asyncio as aioredis
-import json
+import asyncio
+import orjson
+import math
+import struct
+import time
 import logging
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Tuple, Any
 import os
 
 logger = logging.getLogger(__name__)
 
+ACTIVE_BUSES_KEY = "active_buses_zset"
+BUS_UPDATES_STREAM = "bus_updates"
+BUS_UPDATES_GROUP = "bus_update_consumers"
+BUS_UPDATES_JSON_CHANNEL = "bus_updates_json"
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "64"))
+
+# Seconds a bus stays active after its last write, matching the record TTL
+ACTIVE_WINDOW = 300
+
+# Seconds between refreshes of a bus's index and history TTLs
+TTL_REFRESH_INTERVAL = 60
+
+# Prebound key formatters for the per-bus hot paths; the bytes variant takes
+# the raw ids read back from the active bus index
+_BUS_KEY = "bus:{}".format
+_BUS_KEY_BYTES = b"bus:%b".__mod__
+# History streams live under their own suffix: pre-stream deployments kept
+# list-typed bus:{id}:history keys, and XADD on those fails with WRONGTYPE
+_HISTORY_KEY = "bus:{}:track".format
+
+# Stores a packed bus record, indexes the bus, appends its history entry and
+# publishes the update in one server-side call.
+# KEYS: bus record, history stream, active bus index, updates stream
+# ARGV: bus id, packed record, frame header, refresh TTLs flag (1/0), write time,
+#       JSON channel, JSON message (empty to skip), history field/value pairs...
+LUA_TICK = """
+local refresh = ARGV[4] == '1'
+redis.call('SET', KEYS[1], ARGV[2], 'EX', 300)
+redis.call('ZADD', KEYS[3], ARGV[5], ARGV[1])
+if refresh then
+    redis.call('EXPIRE', KEYS[3], 600)
+end
+if #ARGV > 7 then
+    redis.call('XADD', KEYS[2], 'MAXLEN', '~', 60, '*', unpack(ARGV, 8))
+    if refresh then
+        redis.call('EXPIRE', KEYS[2], 3600)
+    end
+end
+redis.call('XADD', KEYS[4], 'MAXLEN', '~', 10000, '*', 'frame', ARGV[3] .. ARGV[2])
+if ARGV[7] ~= '' then
+    redis.call('PUBLISH', ARGV[6], ARGV[7])
+end
+"""
+
+# Byte field names of history stream entries as returned by the bytes-mode
+# client, mapped to the names used in history dicts
+_K_LAT = b"lat"
+_K_LON = b"lon"
+_K_TIMESTAMP = b"timestamp"
+_K_SPEED = b"speed"
+_HISTORY_FIELDS = {_K_LAT: "lat", _K_LON: "lon", _K_TIMESTAMP: "timestamp", _K_SPEED: "speed"}
+
+# Field holding the update frame in bus update stream entries
+_K_FRAME = b"frame"
+
+# Packed bus record: lat, lon, speed, bearing, timestamp (NaN when missing) and
+# the route_id length, followed by the route_id and id bytes
+_STRUCT = struct.Struct("<dddddH")
+_STRUCT_SIZE = _STRUCT.size
+
+# Header byte of published update frames; the body is a packed bus record
+_UPDATE_FRAME = b"\x01"
+
 class RedisStorage:
     """Redis storage for real-time bus data and caching"""
     
     def __init__(self, redis_url: str = None):
         self.redis_url = redis_url or os.getenv("REDIS_URL", "redis://localhost:6379")
+        self.pool = None
         self.redis = None
-        self.pubsub = None
+        self.tick_script = None
+        
+        # Also publish JSON updates for legacy subscribers (off by default)
+        self.publish_json = os.getenv("PUBLISH_JSON_UPDATES", "false").lower() == "true"
+        
+        # Monotonic time each bus last had its index and history TTLs refreshed
+        self._last_refresh: Dict[str, float] = {}
     
     async def connect(self):
         """Connect to Redis"""
         try:
-            self.redis = aioredis.from_url(self.redis_url, decode_responses=True)
+            # Pool sized so concurrent stores, reads and publishes don't queue on
+            # each other; bytes mode so packed bus records round-trip untouched
+            self.pool = aioredis.ConnectionPool.from_url(
+                self.redis_url,
+                max_connections=REDIS_MAX_CONNECTIONS,
+                health_check_interval=30,
+                decode_responses=False
+            )
+            self.redis = aioredis.Redis(connection_pool=self.pool)
             await self.redis.ping()
+            self.tick_script = self.redis.register_script(LUA_TICK)
             logger.info("Connected to Redis successfully")
         except Exception as e:
             logger.error(f"Failed to connect to Redis: {e}")
             # For development, continue without Redis
+            if self.pool:
+                await self.pool.disconnect()
+            self.pool = None
             self.redis = None
     
     async def disconnect(self):
         """Disconnect from Redis"""
         if self.redis:
             await self.redis.close()
+        if self.pool:
+            # The client doesn't own an explicitly passed pool, so release it here
+            await self.pool.disconnect()
     
-    async def store_bus_position(self, bus_id: str, bus_data: Dict):
-        """Store bus position data"""
+    async def record_and_publish(self, bus_id: str, bus_data: Dict):
+        """Store bus position data and publish it to subscribers with one atomic script call"""
         if not self.redis:
             return
         
         try:
-            # Filter out None values before storing
-            filtered_data = {k: v for k, v in bus_data.items() if v is not None}
-            
-            # Store latest position as hash
-            key = f"bus:{bus_id}"
-            if filtered_data:  # Only store if we have valid data
-                # Use individual hset calls instead of mapping for compatibility
-                for field, value in filtered_data.items():
-                    await self.redis.hset(key, field, str(value))
-                await self.redis.expire(key, 300)  # 5 minute TTL
-            
-            # Store in position history list
-            history_key = f"bus:{bus_id}:history"
-            position_entry = {
-                "lat": bus_data.get("lat"),
-                "lon": bus_data.get("lon"),
-                "timestamp": bus_data.get("timestamp"),
-                "speed": bus_data.get("speed")
-            }
+            keys, args, refresh = self._tick_arguments(
+                bus_id,
+                bus_data["lat"],
+                bus_data["lon"],
+                bus_data["timestamp"],
+                bus_data.get("speed"),
+                bus_data.get("bearing"),
+                bus_data["route_id"],
+                bus_data
+            )
+            await self.tick_script(keys=keys, args=args)
             
-            # Filter out None values from history entry
-            position_entry = {k: v for k, v in position_entry.items() if v is not None}
+            if refresh:
+                self._mark_refreshed([bus_id])
             
-            if position_entry:  # Only store if we have valid position data
-                await self.redis.lpush(history_key, json.dumps(position_entry))
-                await self.redis.ltrim(history_key, 0, 59)  # Keep last 60 positions
-                await self.redis.expire(history_key, 3600)  # 1 hour TTL
+        except Exception as e:
+            logger.error(f"Error recording bus update: {e}")
+    
+    async def record_and_publish_many(self, positions: List[Tuple]):
+        """Store and publish (id, lat, lon, timestamp, speed, bearing, route_id) positions in a single pipelined round-trip"""
+        if not self.redis or not positions:
+            return
+        
+        try:
+            refreshed = []
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for position in positions:
+                    keys, args, refresh = self._tick_arguments(*position)
+                    await self.tick_script(keys=keys, args=args, client=pipe)
+                    if refresh:
+                        refreshed.append(position[0])
+                await pipe.execute()
+            
+            self._mark_refreshed(refreshed)
             
         except Exception as e:
-            logger.error(f"Error storing bus position: {e}")
+            logger.error(f"Error recording bus updates: {e}")
+    
+    def _tick_arguments(self, bus_id: str, lat: float, lon: float, timestamp: float,
+                        speed: Optional[float], bearing: Optional[float], route_id: Optional[str],
+                        bus_data: Optional[Dict] = None):
+        """Build the keys and arguments of a tick script call from plain position values, and whether it refreshes TTLs"""
+        keys = [_BUS_KEY(bus_id), _HISTORY_KEY(bus_id), ACTIVE_BUSES_KEY, BUS_UPDATES_STREAM]
+        refresh = self._refresh_due(bus_id)
+        
+        message = b""
+        if self.publish_json:
+            if bus_data is None:
+                bus_data = {
+                    "id": bus_id,
+                    "lat": lat,
+                    "lon": lon,
+                    "route_id": route_id,
+                    "speed": speed,
+                    "timestamp": timestamp,
+                    "bearing": bearing,
+                    "trip_id": None
+                }
+            message = orjson.dumps(bus_data)
+        
+        args = [
+            bus_id,
+            self._pack_record(bus_id, lat, lon, timestamp, speed, bearing, route_id),
+            _UPDATE_FRAME,
+            1 if refresh else 0,
+            time.time(),
+            BUS_UPDATES_JSON_CHANNEL,
+            message,
+            "lat", lat,
+            "lon", lon,
+            "timestamp", timestamp
+        ]
+        # Speed is the only optional history field
+        if speed is not None:
+            args.append("speed")
+            args.append(speed)
+        return keys, args, refresh
+    
+    def _refresh_due(self, bus_id: str) -> bool:
+        """Check whether a bus's index and history TTLs are due a refresh"""
+        last_refresh = self._last_refresh.get(bus_id)
+        return last_refresh is None or time.monotonic() - last_refresh >= TTL_REFRESH_INTERVAL
+    
+    def _mark_refreshed(self, bus_ids: List[str]):
+        """Record TTL refreshes once the writes carrying them have succeeded"""
+        now = time.monotonic()
+        for bus_id in bus_ids:
+            self._last_refresh[bus_id] = now
+    
+    def _pack_bus(self, bus_data: Dict) -> bytes:
+        """Pack a bus position into its binary record"""
+        return self._pack_record(
+            bus_data["id"],
+            bus_data["lat"],
+            bus_data["lon"],
+            bus_data["timestamp"],
+            bus_data.get("speed"),
+            bus_data.get("bearing"),
+            bus_data["route_id"]
+        )
+    
+    def _pack_record(self, bus_id: str, lat: float, lon: float, timestamp: float,
+                     speed: Optional[float], bearing: Optional[float], route_id: Optional[str]) -> bytes:
+        """Pack bus position values into a binary record"""
+        route = route_id.encode() if route_id else b""
+        header = _STRUCT.pack(
+            lat,
+            lon,
+            speed if speed is not None else math.nan,
+            bearing if bearing is not None else math.nan,
+            timestamp,
+            len(route)
+        )
+        return header + route + bus_id.encode()
+    
+    def _unpack_bus(self, record: bytes) -> Dict:
+        """Unpack a binary bus record back into a position dict"""
+        lat, lon, speed, bearing, timestamp, route_len = _STRUCT.unpack_from(record)
+        route_end = _STRUCT_SIZE + route_len
+        return {
+            "id": record[route_end:].decode(),
+            "lat": lat,
+            "lon": lon,
+            "route_id": record[_STRUCT_SIZE:route_end].decode(),
+            "speed": None if speed != speed else speed,  # NaN check
+            "timestamp": timestamp,
+            "bearing": None if bearing != bearing else bearing
+        }
+    
+    def _unpack_buses(self, records: List[Optional[bytes]]) -> List[Dict]:
+        """Unpack binary bus records into position dicts, skipping missing records"""
+        unpack_bus = self._unpack_bus
+        buses = []
+        for record in records:
+            if record:
+                buses.append(unpack_bus(record))
+        return buses
+    
+    def _decode_hash(self, data: Dict) -> Dict:
+        """Decode the field names and values of a hash read from the bytes-mode client"""
+        return {k.decode(): v.decode() for k, v in data.items()}
     
     async def get_bus_position(self, bus_id: str) -> Optional[Dict]:
         """Get latest bus position"""
@@ -73,19 +273,10 @@ class RedisStorage:
             return None
         
         try:
-            key = f"bus:{bus_id}"
-            data = await self.redis.hgetall(key)
-            if data:
-                # Convert string values back to appropriate types
-                return {
-                    "id": data.get("id"),
-                    "lat": float(data.get("lat", 0)),
-                    "lon": float(data.get("lon", 0)),
-                    "route_id": data.get("route_id"),
-                    "speed": float(data.get("speed", 0)) if data.get("speed") else None,
-                    "timestamp": float(data.get("timestamp", 0)),
-                    "bearing": float(data.get("bearing", 0)) if data.get("bearing") else None
-                }
+            key = _BUS_KEY(bus_id)
+            record = await self.redis.get(key)
+            if record:
+                return self._unpack_bus(record)
         except Exception as e:
             logger.error(f"Error getting bus position: {e}")
         
@@ -97,25 +288,15 @@ class RedisStorage:
             return []
         
         try:
-            # Get all bus keys
-            keys = await self.redis.keys("bus:*")
-            # Filter out history keys
-            position_keys = [key for key in keys if not key.endswith(":history")]
-            
-            buses = []
-            for key in position_keys:
-                data = await self.redis.hgetall(key)
-                if data:
-                    bus_data = {
-                        "id": data.get("id"),
-                        "lat": float(data.get("lat", 0)),
-                        "lon": float(data.get("lon", 0)),
-                        "route_id": data.get("route_id"),
-                        "speed": float(data.get("speed", 0)) if data.get("speed") else None,
-                        "timestamp": float(data.get("timestamp", 0)),
-                        "bearing": float(data.get("bearing", 0)) if data.get("bearing") else None
-                    }
-                    buses.append(bus_data)
+            # Get buses written within the active window
+            bus_ids = await self.redis.zrangebyscore(ACTIVE_BUSES_KEY, time.time() - ACTIVE_WINDOW, "+inf")
+            if not bus_ids:
+                return []
+            
+            # Fetch every record in one round-trip
+            records = await self.redis.mget([_BUS_KEY_BYTES(bus_id) for bus_id in bus_ids])
+            
+            buses = self._unpack_buses(records)
             
             return buses
             
@@ -129,16 +310,14 @@ class RedisStorage:
             return []
         
         try:
-            history_key = f"bus:{bus_id}:history"
-            history_data = await self.redis.lrange(history_key, 0, limit - 1)
+            history_key = _HISTORY_KEY(bus_id)
+            entries = await self.redis.xrevrange(history_key, count=limit)
             
-            history = []
-            for entry in history_data:
-                try:
-                    position = json.loads(entry)
-                    history.append(position)
-                except json.JSONDecodeError:
-                    continue
+            # float() parses the raw bytes directly, so nothing is decoded to str first
+            history = [
+                {_HISTORY_FIELDS[field]: float(value) for field, value in fields.items()}
+                for _, fields in entries
+            ]
             
             return history
             
@@ -167,38 +346,95 @@ class RedisStorage:
         try:
             key = f"anomaly:{bus_id}"
             data = await self.redis.hgetall(key)
-            return data if data else None
+            return self._decode_hash(data) if data else None
             
         except Exception as e:
             logger.error(f"Error getting anomaly data: {e}")
             return None
     
     async def publish_bus_update(self, bus_data: Dict):
-        """Publish bus update to subscribers"""
+        """Publish bus update to the updates stream (use record_and_publish when also storing it)"""
         if not self.redis:
             return
         
         try:
-            channel = "bus_updates"
-            message = json.dumps(bus_data)
-            await self.redis.publish(channel, message)
+            frame = _UPDATE_FRAME + self._pack_bus(bus_data)
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.xadd(BUS_UPDATES_STREAM, {_K_FRAME: frame}, maxlen=10000, approximate=True)
+                if self.publish_json:
+                    pipe.publish(BUS_UPDATES_JSON_CHANNEL, orjson.dumps(bus_data))
+                await pipe.execute()
             
         except Exception as e:
             logger.error(f"Error publishing bus update: {e}")
     
-    async def subscribe_to_updates(self):
-        """Subscribe to bus updates"""
+    def parse_bus_update(self, message: bytes) -> Dict:
+        """Parse a published bus update from a binary frame or a legacy JSON message"""
+        if message[:1] == _UPDATE_FRAME:
+            return self._unpack_bus(message[1:])
+        return orjson.loads(message)
+    
+    async def subscribe_to_updates(self, consumer: str, group: str = BUS_UPDATES_GROUP,
+                                   count: int = 500, block: int = 50):
+        """
+        Yield batches of bus updates read by a consumer of the updates stream's consumer group.
+        
+        Consumers sharing a group split the stream between them, each update going to
+        only one of them; every consumer that needs all updates must use its own group.
+        Updates left unacknowledged under this consumer name (e.g. by a crash mid-batch)
+        are delivered again first. Read errors are retried with backoff.
+        """
         if not self.redis:
-            return None
+            return
         
-        try:
-            self.pubsub = self.redis.pubsub()
-            await self.pubsub.subscribe("bus_updates")
-            return self.pubsub
+        await self._create_update_group(group)
+        
+        # "0" reads this consumer's pending entries; ">" reads new ones once they're drained
+        last_id = "0"
+        delay = 0.1
+        
+        while True:
+            try:
+                response = await self.redis.xreadgroup(
+                    group, consumer, {BUS_UPDATES_STREAM: last_id}, count=count, block=block
+                )
+            except Exception as e:
+                logger.error(f"Error reading bus updates: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 5.0)
+                
+                # The group is gone if the stream was deleted, so recreate it
+                if "NOGROUP" in str(e):
+                    await self._create_update_group(group)
+                continue
             
-        except Exception as e:
-            logger.error(f"Error subscribing to updates: {e}")
-            return None
+            delay = 0.1
+            
+            for _, entries in response:
+                if last_id != ">":
+                    if not entries:
+                        last_id = ">"
+                        continue
+                    last_id = entries[-1][0]
+                
+                # Pending entries already trimmed from the stream come back without fields
+                updates = [self.parse_bus_update(fields[_K_FRAME]) for _, fields in entries if fields]
+                if updates:
+                    yield updates
+                
+                try:
+                    await self.redis.xack(BUS_UPDATES_STREAM, group, *[entry_id for entry_id, _ in entries])
+                except Exception as e:
+                    logger.error(f"Error acknowledging bus updates: {e}")
+    
+    async def _create_update_group(self, group: str):
+        """Create a consumer group on the updates stream, creating the stream if needed"""
+        try:
+            await self.redis.xgroup_create(BUS_UPDATES_STREAM, group, id="$", mkstream=True)
+        except aioredis.ResponseError as e:
+            # The group already exists when another consumer created it first
+            if "BUSYGROUP" not in str(e):
+                raise
     
     async def store_route_cache(self, route_id: str, route_data: Dict):
         """Cache route data"""
@@ -221,7 +457,7 @@ class RedisStorage:
         try:
             key = f"route:{route_id}"
             data = await self.redis.hgetall(key)
-            return data if data else None
+            return self._decode_hash(data) if data else None
             
         except Exception as e:
             logger.error(f"Error getting cached route data: {e}")
@@ -233,9 +469,16 @@ class RedisStorage:
             return
         
         try:
-            # This would be called periodically to clean up old data
-            # Redis TTL handles most of this automatically
-            pass
+            # Bus records and history expire through their TTLs; this drops
+            # buses that have gone quiet from the index in one range delete
+            await self.redis.zremrangebyscore(ACTIVE_BUSES_KEY, "-inf", time.time() - ACTIVE_WINDOW)
+            
+            # Forget refresh times of quiet buses so the map doesn't grow forever
+            cutoff = time.monotonic() - ACTIVE_WINDOW
+            self._last_refresh = {
+                bus_id: last_refresh for bus_id, last_refresh in self._last_refresh.items()
+                if last_refresh > cutoff
+            }
             
         except Exception as e:
             logger.error(f"Error cleaning up expired data: {e}")
@@ -1,32 +1,74 @@
 from fastapi import WebSocket
-from typing import List, Dict, Any
+from starlette.websockets import WebSocketState
+import asyncio
+from typing import List, Dict, Any, Set, Tuple, Optional, Callable
 import json
 import logging
+import orjson
+import msgpack
+import numpy as np
 
 logger = logging.getLogger(__name__)
 
+def encode_message(message: Dict[str, Any]) -> bytes:
+    """Serialize a message with orjson, accepting NumPy values from the batched detector path"""
+    return orjson.dumps(message, option=orjson.OPT_SERIALIZE_NUMPY)
+
+def _msgpack_default(value: Any) -> Any:
+    """Convert NumPy scalars and arrays that msgpack can't pack natively"""
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.tolist()
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+def encode_msgpack(message: Dict[str, Any]) -> bytes:
+    """Serialize a message with msgpack for clients that negotiated binary frames"""
+    return msgpack.packb(message, default=_msgpack_default)
+
+# Frame encoders by the format a connection negotiated
+ENCODERS: Dict[str, Callable[[Dict[str, Any]], bytes]] = {
+    "json": encode_message,
+    "msgpack": encode_msgpack
+}
+
 class ConnectionManager:
     """Manages WebSocket connections for real-time updates"""
     
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        self.active_connections: Set[WebSocket] = set()
+        
+        # Connections that negotiated msgpack frames; all others get JSON
+        self.msgpack_connections: Set[WebSocket] = set()
+        
+        # Encoded snapshot frames by format and the bus-set version they were built from
+        self._snapshot_cache: Optional[Tuple[int, Dict[str, bytes]]] = None
     
-    async def connect(self, websocket: WebSocket):
-        """Accept a new WebSocket connection"""
+    async def connect(self, websocket: WebSocket, frame_format: str = "json"):
+        """Accept a new WebSocket connection, sending it frames in the given format"""
         await websocket.accept()
-        self.active_connections.append(websocket)
+        self.active_connections.add(websocket)
+        if frame_format == "msgpack":
+            self.msgpack_connections.add(websocket)
         logger.info(f"New WebSocket connection. Total connections: {len(self.active_connections)}")
     
     def disconnect(self, websocket: WebSocket):
         """Remove a WebSocket connection"""
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
+        self.active_connections.discard(websocket)
+        self.msgpack_connections.discard(websocket)
         logger.info(f"WebSocket disconnected. Total connections: {len(self.active_connections)}")
     
+    def frame_format(self, websocket: WebSocket) -> str:
+        """Get the frame format a connection negotiated"""
+        return "msgpack" if websocket in self.msgpack_connections else "json"
+    
     async def send_personal_message(self, message: Dict[str, Any], websocket: WebSocket):
         """Send a message to a specific WebSocket connection"""
+        encode = ENCODERS[self.frame_format(websocket)]
+        await self.send_personal_bytes(encode(message), websocket)
+    
+    async def send_personal_bytes(self, payload: bytes, websocket: WebSocket):
+        """Send an already encoded message to a specific WebSocket connection"""
         try:
-            await websocket.send_json(message)
+            await websocket.send_bytes(payload)
         except Exception as e:
             logger.error(f"Error sending personal message: {e}")
             self.disconnect(websocket)
@@ -36,17 +78,56 @@ class ConnectionManager:
         if not self.active_connections:
             return
         
-        disconnected = []
-        for connection in self.active_connections:
-            try:
-                await connection.send_json(message)
-            except Exception as e:
-                logger.error(f"Error broadcasting message: {e}")
-                disconnected.append(connection)
+        # Serialize once per format in use for all connections
+        frames = {
+            frame_format: ENCODERS[frame_format](message)
+            for frame_format in self._formats_in_use()
+        }
+        await self.broadcast_frames(frames)
+    
+    async def broadcast_frames(self, frames: Dict[str, bytes]):
+        """Broadcast already encoded messages, keyed by frame format, to all connected WebSocket clients"""
+        if not self.active_connections:
+            return
+        
+        # Send to all connections concurrently so one slow client doesn't delay the rest
+        connections = tuple(self.active_connections)
+        msgpack_connections = self.msgpack_connections
+        json_frame = frames.get("json")
+        msgpack_frame = frames.get("msgpack")
+        failed = await asyncio.gather(
+            *(
+                self._safe_send(connection, msgpack_frame if connection in msgpack_connections else json_frame)
+                for connection in connections
+            )
+        )
+        
+        # Remove disconnected connections in one pass
+        for connection in failed:
+            if connection is not None:
+                self.disconnect(connection)
+    
+    async def _safe_send(self, connection: WebSocket, payload: bytes) -> Optional[WebSocket]:
+        """Send a frame to one connection, returning the connection if it is closed or the send failed"""
+        if (connection.client_state != WebSocketState.CONNECTED
+                or connection.application_state != WebSocketState.CONNECTED):
+            return connection
         
-        # Remove disconnected connections
-        for connection in disconnected:
-            self.disconnect(connection)
+        try:
+            await connection.send_bytes(payload)
+        except Exception as e:
+            logger.error(f"Error broadcasting message: {e}")
+            return connection
+        return None
+    
+    def _formats_in_use(self) -> List[str]:
+        """Get the frame formats needed by the current connections"""
+        formats = []
+        if len(self.msgpack_connections) < len(self.active_connections):
+            formats.append("json")
+        if self.msgpack_connections:
+            formats.append("msgpack")
+        return formats
     
     async def broadcast_bus_update(self, bus_data: Dict[str, Any]):
         """Broadcast a bus update to all connected clients"""
@@ -56,13 +137,34 @@ class ConnectionManager:
         }
         await self.broadcast(message)
     
-    async def broadcast_snapshot(self, buses_data: List[Dict[str, Any]]):
-        """Broadcast a snapshot of all buses to all connected clients"""
-        message = {
-            "type": "snapshot",
-            "data": buses_data
+    def snapshot_frame(self, version: int, load_buses: Callable[[], List[Dict[str, Any]]],
+                       frame_format: str = "json") -> bytes:
+        """Get the encoded snapshot frame for a bus-set version, loading and encoding the buses only when it changed"""
+        if self._snapshot_cache is None or self._snapshot_cache[0] != version:
+            self._snapshot_cache = (version, {})
+        
+        frames = self._snapshot_cache[1]
+        if frame_format not in frames:
+            frames[frame_format] = ENCODERS[frame_format]({
+                "type": "snapshot",
+                "data": load_buses()
+            })
+        return frames[frame_format]
+    
+    async def broadcast_snapshot(self, buses_data: List[Dict[str, Any]], version: Optional[int] = None):
+        """Broadcast a snapshot of all buses to all connected clients, reusing the cached frames for a known version"""
+        if version is None:
+            await self.broadcast({
+                "type": "snapshot",
+                "data": buses_data
+            })
+            return
+        
+        frames = {
+            frame_format: self.snapshot_frame(version, lambda: buses_data, frame_format)
+            for frame_format in self._formats_in_use()
         }
-        await self.broadcast(message)
+        await self.broadcast_frames(frames)
     
     def get_connection_count(self) -> int:
         """Get the number of active connections"""
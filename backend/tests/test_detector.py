@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from app.detector import haversine_sum, off_route_mask
+
+EARTH_RADIUS = 6371000.0  # meters
+
+def reference_haversine_sum(lat_rad: np.ndarray, lon_rad: np.ndarray) -> float:
+    """Total track length with the sine form of the haversine, sin²(x/2)"""
+    dlat = np.diff(lat_rad)
+    dlon = np.diff(lon_rad)
+    a = np.sin(dlat/2)**2 + np.cos(lat_rad[:-1]) * np.cos(lat_rad[1:]) * np.sin(dlon/2)**2
+    return float(np.sum(2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))))
+
+def random_track(step: float, seed: int, points: int = 60):
+    """Track around Denver made of fixed-length steps (meters) in random directions, in radians"""
+    rng = np.random.default_rng(seed)
+    heading = rng.uniform(0, 2 * np.pi, points - 1)
+    lat0 = np.radians(39.74)
+    lon0 = np.radians(-104.99)
+    angle = step / EARTH_RADIUS
+    
+    lat = lat0 + np.concatenate(([0.0], np.cumsum(angle * np.cos(heading))))
+    lon = lon0 + np.concatenate(([0.0], np.cumsum(angle * np.sin(heading) / np.cos(lat0))))
+    return lat, lon
+
+def relative_errors(step: float, tracks: int = 50) -> np.ndarray:
+    """Relative difference between haversine_sum and the sine form over random tracks"""
+    errors = []
+    for seed in range(tracks):
+        lat, lon = random_track(step, seed)
+        reference = reference_haversine_sum(lat, lon)
+        errors.append(abs(haversine_sum(lat, lon) - reference) / reference)
+    return np.array(errors)
+
+@pytest.mark.parametrize("step, typical, worst", [
+    (1000.0, 3e-10, 1e-9),
+    (10.0, 3e-6, 1e-5),
+    (1.0, 3e-4, 1e-3),
+])
+def test_half_angle_matches_sine_form(step, typical, worst):
+    errors = relative_errors(step)
+    assert np.median(errors) < typical
+    assert errors.max() < worst
+
+def test_sub_meter_steps_stay_within_tolerance():
+    # 1 - cos(x) cancels for tiny angles, so ~0.1 m steps may be off by
+    # several percent, but the error must stay bounded.
+    errors = relative_errors(0.1)
+    assert errors.max() < 0.15
+
+def test_single_point_track_has_no_length():
+    lat, lon = random_track(10.0, seed=0, points=1)
+    assert haversine_sum(lat, lon) == 0.0
+
+def test_off_route_mask_flags_missing_coordinates():
+    lat = np.array([39.74, np.nan, 42.0, 39.74])
+    lon = np.array([-104.99, -104.99, -104.99, np.nan])
+    assert off_route_mask(lat, lon).tolist() == [False, True, True, True]
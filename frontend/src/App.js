@@ -26,6 +26,9 @@ function App() {
   useEffect(() => {
     const connectWebSocket = () => {
       const ws = new WebSocket('ws://localhost:8000/ws');
+      // The backend sends JSON as binary frames
+      ws.binaryType = 'arraybuffer';
+      const decoder = new TextDecoder();
       
       ws.onopen = () => {
         console.log('WebSocket connected');
@@ -34,7 +37,8 @@ function App() {
       
       ws.onmessage = (event) => {
         try {
-          const message = JSON.parse(event.data);
+          const text = typeof event.data === 'string' ? event.data : decoder.decode(event.data);
+          const message = JSON.parse(text);
           
           if (message.type === 'snapshot') {
             // Initial snapshot of all buses
@@ -49,6 +53,15 @@ function App() {
               ...prev,
               [message.data.id]: message.data
             }));
+          } else if (message.type === 'bus_batch_update') {
+            // All bus updates from one simulator tick
+            setBuses(prev => {
+              const next = { ...prev };
+              message.data.forEach(bus => {
+                next[bus.id] = bus;
+              });
+              return next;
+            });
           }
         } catch (error) {
           console.error('Error parsing WebSocket message:', error);